@@ -1,27 +1,234 @@
 import numpy as np 
 from numba import njit
-from scipy.signal import find_peaks
-from scipy.stats.mstats import zscore
 import matplotlib.pyplot as plt
 
-@njit
-def _rolling_std_numba(x, window=20):
-    """Rolling standard deviation, faster with numba
+@njit(cache=True)
+def _rolling_std_numba(x, window=20, std=None):
+    """Rolling standard deviation, faster with numba.
+    Uses a sliding Welford update, i.e. O(1) per sample.
 
     :param x: array
     :type x: numpy.ndarray
     :param window: window size for std, defaults to 20
     :type window: int, optional
+    :param std: float32 output buffer of same size as x, defaults to None
+    :type std: numpy.ndarray, optional
     :return: filtered signal
     :rtype: numpy.ndarray
     """
-    std = np.zeros_like(x)
-    for i in range(window, x.shape[0]):
-        std[i-window//2] = np.std(x[i-window:i])
+    if std is None:
+        std = np.zeros(x.shape[0], dtype=np.float32)
+
+    else:
+        # Reused buffer, clear samples that are not computed below
+        std[:window-window//2] = 0
+        std[max(x.shape[0]-window//2, 0):] = 0
+
+    if x.shape[0] <= window:
+        return std
+
+    # Welford's algorithm on the first window
+    mean = 0.
+    m2 = 0.
+    for i in range(window):
+        delta = x[i] - mean
+        mean += delta / (i + 1)
+        m2 += delta * (x[i] - mean)
+
+    std[window-window//2] = np.sqrt(max(m2, 0.) / window)
+
+    # Slide the window by replacing the oldest with the newest sample,
+    # such that each step is O(1) instead of O(window)
+    for i in range(window+1, x.shape[0]):
+        old = x[i-window-1]
+        new = x[i-1]
+        old_mean = mean
+        mean += (new - old) / window
+        m2 += (new - old) * (new - mean + old - old_mean)
+        std[i-window//2] = np.sqrt(max(m2, 0.) / window)
         
     return std
 
-def _findTriggerEnd(reference_signal, window=101, prominence=1, zscoring=True):
+@njit(cache=True)
+def _local_maxima(x):
+    """Finds local maxima, flat peaks are reported at their (lower) center,
+    as in :func:`scipy.signal.find_peaks`.
+
+    :param x: array
+    :type x: numpy.ndarray
+    :return: peak locations
+    :rtype: numpy.ndarray
+    """
+    peaks = np.empty(x.shape[0] // 2, dtype=np.int64)
+    n_peaks = 0
+
+    i = 1
+    while i < x.shape[0] - 1:
+        if x[i-1] < x[i]:
+            i_ahead = i + 1
+
+            # Skip flat peak
+            while i_ahead < x.shape[0] - 1 and x[i_ahead] == x[i]:
+                i_ahead += 1
+
+            if x[i_ahead] < x[i]:
+                peaks[n_peaks] = (i + i_ahead - 1) // 2
+                n_peaks += 1
+                i = i_ahead
+
+        i += 1
+
+    return peaks[:n_peaks]
+
+@njit(cache=True)
+def _find_peaks_height(x, height):
+    """Finds local maxima with a minimum height in a single pass.
+
+    :param x: array
+    :type x: numpy.ndarray
+    :param height: minimum peak height
+    :type height: float
+    :return: peak locations
+    :rtype: numpy.ndarray
+    """
+    peaks = _local_maxima(x)
+
+    return peaks[x[peaks] >= height]
+
+@njit(cache=True)
+def _find_peaks_prominence(x, prominence):
+    """Finds local maxima with a minimum prominence. The lowest point
+    between each sample and the closest higher sample is found for both
+    sides using a monotonic stack, i.e. in O(n).
+
+    :param x: array
+    :type x: numpy.ndarray
+    :param prominence: minimum peak prominence
+    :type prominence: float
+    :return: peak locations
+    :rtype: numpy.ndarray
+    """
+    n = x.shape[0]
+    left_min = np.empty(n, dtype=x.dtype)
+    right_min = np.empty(n, dtype=x.dtype)
+    stack = np.empty(n, dtype=np.int64)
+
+    # Left to right, minimum since the last higher sample
+    top = 0
+    for i in range(n):
+        m = x[i]
+
+        while top and x[stack[top-1]] <= x[i]:
+            top -= 1
+            m = min(m, left_min[stack[top]])
+
+        left_min[i] = m
+        stack[top] = i
+        top += 1
+
+    # Right to left, minimum until the next higher sample
+    top = 0
+    for i in range(n-1, -1, -1):
+        m = x[i]
+
+        while top and x[stack[top-1]] <= x[i]:
+            top -= 1
+            m = min(m, right_min[stack[top]])
+
+        right_min[i] = m
+        stack[top] = i
+        top += 1
+
+    peaks = _local_maxima(x)
+    prominences = x[peaks] - np.maximum(left_min[peaks], right_min[peaks])
+
+    return peaks[prominences >= prominence]
+
+def _find_rising_edges(x, threshold):
+    """Finds rising edges, i.e. the first sample above the threshold.
+
+    :param x: array
+    :type x: numpy.ndarray
+    :param threshold: threshold to be crossed
+    :type threshold: float
+    :return: edge locations
+    :rtype: numpy.ndarray
+    """
+    above = x > threshold
+
+    return np.flatnonzero(above[1:] & ~above[:-1]) + 1
+
+def _zscore(x, out=None):
+    """Z-scores the signal, i.e. zero mean and unit standard deviation
+
+    :param x: array
+    :type x: numpy.ndarray
+    :param out: output buffer of same size as x, defaults to None
+    :type out: numpy.ndarray, optional
+    :return: z-scored signal
+    :rtype: numpy.ndarray
+    """
+    # Accumulate in float64, also for float32 signals
+    m = x.mean(dtype=np.float64)
+    s = x.std(dtype=np.float64)
+
+    if out is None:
+        return (x - m) / s
+
+    np.subtract(x, m, out=out)
+    out /= s
+
+    return out
+
+@njit(cache=True, error_model='numpy')
+def _trigger_pipeline(x, window, prominence, zscoring, std=None):
+    """Rolling standard deviation, normalization and peak finding
+    in a single compiled function.
+
+    :param x: reference signal
+    :type x: numpy.ndarray
+    :param window: window size
+    :type window: int
+    :param prominence: prominence for peak finding
+    :type prominence: float
+    :param zscoring: z-scoring instead of min-max normalization
+    :type zscoring: bool
+    :param std: float32 output buffer of same size as x, defaults to None
+    :type std: numpy.ndarray, optional
+    :return: first peak location (-1 if no peak) and normalized std signal
+    :rtype: tuple(int, numpy.ndarray)
+    """
+    std = _rolling_std_numba(x, window, std)
+
+    if zscoring:
+        # Welford's algorithm with float64 accumulators,
+        # as float32 sums lose precision on long signals
+        offset = 0.
+        m2 = 0.
+        for i in range(std.shape[0]):
+            delta = np.float64(std[i]) - offset
+            offset += delta / (i + 1)
+            m2 += delta * (np.float64(std[i]) - offset)
+
+        scale = np.sqrt(m2 / std.shape[0])
+
+    else:
+        offset = np.float64(std.min())
+        scale = np.float64(std.max()) - offset
+
+    # Normalize in place
+    for i in range(std.shape[0]):
+        std[i] = (std[i] - offset) / scale
+
+    peaks = _find_peaks_prominence(std, prominence)
+
+    if len(peaks):
+        return peaks[0], std
+
+    else:
+        return -1, std
+
+def _findTriggerEnd(reference_signal, window=101, prominence=1, zscoring=True, out=None):
     """Uses z-scoring of rolling standard deviation to
     find the end trigger from the camera to synch audio and video.
 
@@ -33,25 +240,121 @@ def _findTriggerEnd(reference_signal, window=101, prominence=1, zscoring=True):
     :type prominence: int, optional
     :param zscoring: enables z-scoring of data before peak finding, defaults to True
     :type zscoring: bool, optional
+    :param out: float32 buffer for std signal, defaults to None
+    :type out: numpy.ndarray, optional
     :return: peak location and std signal
     :rtype: tuple(int, numpy.ndarray)
     """
-    std = _rolling_std_numba(reference_signal, window)
-
-    if zscoring:
-        std = zscore(std)
-        
-    else:
-        std = (std - std.min()) / (std.max() - std.min())
-    
-    peaks = find_peaks(std, prominence=prominence)[0]
+    peak, std = _trigger_pipeline(reference_signal, window, prominence, zscoring, out)
     
-    if len(peaks):
-        return peaks[0], std
+    if peak >= 0:
+        return peak, std
     
     else:
         return False
 
+class Synchronizer:
+    def __init__(self, n):
+        """Synchronizes audio signal with video data using the reference signal.
+        Buffers are allocated once for signals of length n and reused
+        across calls, e.g. for batch processing of recordings.
+
+        .. note::
+            Calls share the same buffers, hence a Synchronizer is not
+            reentrant and must not be used from multiple threads at once.
+            Use :func:`sync` for independent calls.
+
+        :param n: length of reference and audio signal
+        :type n: int
+        """
+        self._reference = np.empty(n, dtype=np.float32)
+        self._std = np.empty(n, dtype=np.float32)
+        self._z = np.empty(n, dtype=np.float32)
+
+    def sync(self, reference_signal, audio_signal, start_frame, end_frame, total_frames, debug=False):
+        """Synchronizes audio signal with video data, see :func:`sync`.
+
+        :param reference_signal: reference signal from camera
+        :type reference_signal: numpy.ndarray
+        :param audio_signal: recorded audio signal
+        :type audio_signal: numpy.ndarray
+        :param start_frame: start frame of region selection
+        :type start_frame: int
+        :param end_frame: end frame of region selection
+        :type end_frame: int
+        :param total_frames: total amount of recorded frames
+        :type total_frames: int
+        :param debug: sets debug mode with additional information and plots, defaults to False
+        :type debug: bool, optional
+        :return: synchronized signal corresponding to video data
+        :rtype: numpy.ndarray
+        """
+        # Single precision is sufficient and halves memory traffic
+        np.copyto(self._reference, reference_signal, casting='unsafe')
+        reference_signal = self._reference
+        audio_signal = np.ascontiguousarray(audio_signal, dtype=np.float32)
+
+        # Find trigger
+        trigger_end, std = _findTriggerEnd(reference_signal, out=self._std)
+
+        # Show found trigger and reference signal
+        if debug:
+            fig = plt.figure()
+            ax = plt.subplot(111)
+            plt.plot(reference_signal.copy(), c='k', alpha=.4, label='raw trace')
+            plt.ylabel("audio [au]")
+
+            ax2 = ax.twinx()
+            plt.plot(std.copy(), c='g', alpha=1, label='z-scored, rolling std')
+            plt.scatter(trigger_end, std[trigger_end], marker="x", color='magenta')
+        
+            fig.legend(loc='best')
+            plt.xlabel("time")
+            plt.ylabel("std")
+
+        # crop audio
+        cropped_reference = reference_signal[:trigger_end]
+        cropped_audio     = audio_signal[:trigger_end]
+
+        # find single frames
+        # Zscore signal because of varying input amplitude
+        z = _zscore(cropped_reference, out=self._z[:trigger_end])
+        np.negative(z, out=z)
+        # At least 1.5 STDs, better 2...
+        frame_idx = _find_rising_edges(z, 1.5)
+
+        # Cross-check frame detection with peak finding
+        if debug:
+            print("Frames from rising edges: {}, from peaks: {}".format(
+                len(frame_idx), 
+                len(_find_peaks_height(z, 1.5))))
+
+        # Use the last X recorded frames
+        recorded_frames = frame_idx[-total_frames:]
+    
+        # Retrieve the indices from first and last selected frame
+        start_frame_idx = recorded_frames[start_frame-1]
+        end_frame_idx = recorded_frames[end_frame-1]
+
+        # Show cropped audio signal, acquired video footage section,
+        # and selected, downloaded frames
+        if debug:
+            plt.figure() 
+            xc = np.arange(0, cropped_audio.shape[0])
+            plt.axvspan(xc[recorded_frames[0]], 
+                xc[-1], 
+                color=(0,0,0,.2), 
+                label="recorded frames")
+            plt.plot(xc, cropped_audio, alpha=.2, label="cropped audio")
+            plt.plot(xc[start_frame_idx:end_frame_idx],
+                cropped_audio[start_frame_idx:end_frame_idx],
+                label="saved footage, in sync")
+        
+            plt.legend(loc='best')
+
+        # Return audio synchronized
+        return cropped_audio[start_frame_idx:end_frame_idx]
+
 def sync(reference_signal, audio_signal, start_frame, end_frame, total_frames, debug=False):
     """Synchronizes audio signal with video data using the reference signal.
 
@@ -74,59 +377,14 @@ def sync(reference_signal, audio_signal, start_frame, end_frame, total_frames, d
     :return: synchronized signal corresponding to video data
     :rtype: numpy.ndarray
     """
-    # Find trigger
-    trigger_end, std = _findTriggerEnd(reference_signal)
-
-    # Show found trigger and reference signal
-    if debug:
-        fig = plt.figure()
-        ax = plt.subplot(111)
-        plt.plot(reference_signal, c='k', alpha=.4, label='raw trace')
-        plt.ylabel("audio [au]")
-
-        ax2 = ax.twinx()
-        plt.plot(std, c='g', alpha=1, label='z-scored, rolling std')
-        plt.scatter(trigger_end, std[trigger_end], marker="x", color='magenta')
-        
-        fig.legend(loc='best')
-        plt.xlabel("time")
-        plt.ylabel("std")
-
-    # crop audio
-    cropped_reference = reference_signal[:trigger_end]
-    cropped_audio     = audio_signal[:trigger_end]
-
-    # find single frames
-    # Zscore signal because of varying input amplitude
-    z = -zscore(cropped_reference)
-    # At least 1.5 STDs, better 2...
-    frame_idx = find_peaks(z, height=1.5)[0]
-
-    # Use the last X recorded frames
-    recorded_frames = frame_idx[-total_frames:]
-    
-    # Retrieve the indices from first and last selected frame
-    start_frame_idx = recorded_frames[start_frame-1]
-    end_frame_idx = recorded_frames[end_frame-1]
-
-    # Show cropped audio signal, acquired video footage section,
-    # and selected, downloaded frames
-    if debug:
-        plt.figure() 
-        xc = np.arange(0, cropped_audio.shape[0])
-        plt.axvspan(xc[recorded_frames[0]], 
-            xc[-1], 
-            color=(0,0,0,.2), 
-            label="recorded frames")
-        plt.plot(xc, cropped_audio, alpha=.2, label="cropped audio")
-        plt.plot(xc[start_frame_idx:end_frame_idx],
-            cropped_audio[start_frame_idx:end_frame_idx],
-            label="saved footage, in sync")
-        
-        plt.legend(loc='best')
+    synchronizer = Synchronizer(len(reference_signal))
 
-    # Return audio synchronized
-    return cropped_audio[start_frame_idx:end_frame_idx]
+    return synchronizer.sync(reference_signal, 
+        audio_signal, 
+        start_frame, 
+        end_frame, 
+        total_frames, 
+        debug=debug)
 
 if __name__ == '__main__':
     import matplotlib.pyplot as plt 
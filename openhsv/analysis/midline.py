@@ -89,11 +89,13 @@ class Midline:
         return self.side_gaws
 
             
-    def pvg(self, steps=64):
+    def pvg(self, steps=64, backend='cpu'):
         """Computes PVG in discrete steps for each side.
 
         :param steps: resolution along each axis, defaults to 64
         :type steps: int, optional
+        :param backend: compute on 'cpu' or on 'gpu' (requires CuPy), defaults to 'cpu'
+        :type backend: str, optional
         :return: phonovibrogram as T x steps*2
         :rtype: numpy.ndarray
         """
@@ -108,7 +110,7 @@ class Midline:
                               steps=steps)
             
         self.labels = labels
-        _pvg = compute_pvg(self.seg, labels, steps=steps)
+        _pvg = compute_pvg(self.seg, labels, steps=steps, backend=backend)
             
         return _pvg
 
@@ -232,13 +234,8 @@ def imageMoments(im, transpose=True, angle_correction=+np.pi/2):
     mu20 = M[2,0] - x_c * M[1,0]
     mu02 = M[0,2] - y_c * M[0,1]
 
-    A = 2*mu11
     B = mu20-mu02
 
-    # Calculate orientation vector
-    xd = (0.5*(1+B/np.sqrt(A**2+B**2)))**0.5
-    yd = (0.5*(1-B/np.sqrt(A**2+B**2)))**0.5
-
     # Calculate major axis of rotation
     angle = 0.5 * np.arctan(2* mu11 / (mu20-mu02+1e-9)) # + angle_correction
 
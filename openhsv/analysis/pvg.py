@@ -28,7 +28,7 @@ def _find_orthogonal_points(x_low, x_high, coef, intercept, steps=64):
     return xs, ys, coef_orth, intercepts_orth
 
 
-@njit
+@njit(parallel=True, cache=True)
 def _create_maps(im_shape, c, i):
     """
     Creates distance maps for all orthogonal axes
@@ -39,41 +39,55 @@ def _create_maps(im_shape, c, i):
     """
     labels = np.zeros((i.shape[0],) + im_shape, dtype=np.float32)
 
+    # Usually there is a single intercept, hence rows are computed in parallel
     for j in range(i.shape[0]):
-        for y in range(im_shape[0]):
+        for y in prange(im_shape[0]):
             for x in range(im_shape[1]):
                 labels[j, y, x] = (y - (c * x + i[j]))
 
     return labels
 
 
-@njit
-def _find_parts(im_shape, labels_parallel, labels_LR):
+def _find_closest(im_shape, xs, ys, coef):
     """
-    Creates a label map depending on distance to axis and left or right
-    axis of anterior posterior axis.
+    Finds the closest orthogonal axis for each pixel. As the orthogonal
+    axes are equally spaced along the anterior posterior axis, the index
+    is given by projecting each pixel onto the anterior posterior axis.
     :param im_shape: tuple, image shape
-    :param labels_parallel: ndarray, from create_maps
-    :param labels_LR: ndarray, from create_maps, but only image shape!
-    :return: ndarray, labels from -steps to +steps, no 0
+    :param xs: ndarray, x from points on AP axis
+    :param ys: ndarray, y from points on AP axis
+    :param coef: float, coef from linear regression of AP axis
+    :return: ndarray, index of closest orthogonal axis from 0 to steps-1
     """
-    labels = np.zeros(im_shape, dtype=np.int8)
+    # Unit vector along the AP axis
+    norm = np.hypot(1, coef)
+    dx, dy = 1 / norm, coef / norm
 
-    for i in range(im_shape[0]):
-        for j in range(im_shape[1]):
-            sign = -1
+    # Position of first point and spacing between points along AP axis
+    t0 = dx * xs[0] + dy * ys[0]
+    dt = dx * (xs[1] - xs[0]) + dy * (ys[1] - ys[0])
 
-            if labels_LR[i, j] >= 0:
-                sign = 1
+    # All points coincide, all orthogonal axes are equally close
+    if dt == 0:
+        return np.zeros(im_shape, dtype=np.int16)
 
-            closest_to = np.argmin(np.sqrt(labels_parallel[:, i, j] ** 2))
+    y, x = np.mgrid[:im_shape[0], :im_shape[1]]
+    closest_to = np.clip(np.round((dx * x + dy * y - t0) / dt), 0, xs.shape[0] - 1)
 
-            #if labels_parallel[closest_to, i, j] < 0:
-            #    closest_to += 1
+    return closest_to.astype(np.int16)
 
-            labels[i, j] = sign * (closest_to + 1)
 
-    return labels
+def _find_parts(closest_to, labels_LR):
+    """
+    Creates a label map depending on distance to axis and left or right
+    axis of anterior posterior axis.
+    :param closest_to: ndarray, from find_closest
+    :param labels_LR: ndarray, from create_maps, but only image shape!
+    :return: ndarray, labels from -steps to +steps, no 0
+    """
+    closest_to = closest_to + 1
+
+    return np.where(labels_LR >= 0, closest_to, -closest_to).astype(np.int8)
 
 
 def get_labels(x_low, x_high, coef, intercept, image_shape, steps=64):
@@ -95,39 +109,133 @@ def get_labels(x_low, x_high, coef, intercept, image_shape, steps=64):
     :rtype: numpy.ndarray
     """
     xs, ys, coef_orth, intercepts_orth = _find_orthogonal_points(x_low, x_high, coef, intercept, steps=steps)
-    labels_parallel = _create_maps(image_shape, coef_orth, intercepts_orth)
+    closest_to = _find_closest(image_shape, xs, ys, coef)
     labels_LR = _create_maps(image_shape, coef, np.array([intercept]))[0]
 
-    labels = _find_parts(image_shape, labels_parallel, labels_LR)
+    labels = _find_parts(closest_to, labels_LR)
 
     return labels
     
-def compute_pvg(s, labels, steps=64):
+def _pvg_bins(labels, steps=64):
+    """Maps labels to the respective PVG column. Left labels (steps to 1)
+    are followed by right labels (-1 to -steps), labels not belonging to any
+    column are mapped to an additional column at 2*steps.
+
+    :param labels: labelled image(s)
+    :type labels: numpy.ndarray
+    :param steps: PVG resolution, defaults to 64
+    :type steps: int, optional
+    :return: PVG column for each pixel
+    :rtype: numpy.ndarray
+    """
+    # Lookup table for labels from -steps-1 to steps+1
+    values = np.arange(-steps - 1, steps + 2)
+    lut = np.where(values > 0, steps - values, steps - values - 1).astype(np.int16)
+    lut[(values == 0) | (np.abs(values) > steps)] = steps * 2
+
+    # Clip labels in place to the lookup table
+    idx = labels.astype(np.int16)
+    np.clip(idx, -steps - 1, steps + 1, out=idx)
+    idx += steps + 1
+
+    return np.take(lut, idx)
+
+@njit(parallel=True, cache=True)
+def _pvg_histogram(s, words, bins, pvg):
+    """Counts segmented pixels in each PVG column. The segmentation is
+    read as 64 bit words, i.e. 8 pixels at once, such that empty
+    background is skipped quickly and only segmented pixels
+    access the label map.
+
+    :param s: segmented area (T x pixels)
+    :type s: numpy.ndarray
+    :param words: segmented area as uint64 view (T x pixels/8)
+    :type words: numpy.ndarray
+    :param bins: PVG column for each pixel (T x pixels)
+    :type bins: numpy.ndarray
+    :param pvg: PVG, time x 2*steps, written in place
+    :type pvg: numpy.ndarray
+    """
+    # Frames are independent and only write to their own PVG row
+    for frame in prange(s.shape[0]):
+        # Integer counts including the column for unassigned labels,
+        # such that counting needs no branches
+        acc = np.zeros(pvg.shape[1] + 1, dtype=np.int64)
+
+        for w in range(words.shape[1]):
+            if words[frame, w] == 0:
+                continue
+
+            for p in range(w * 8, min(w * 8 + 8, bins.shape[1])):
+                acc[bins[frame, p]] += s[frame, p]
+
+        pvg[frame] = acc[:pvg.shape[1]]
+
+def _pvg_histogram_gpu(s, bins, steps=64):
+    """Counts segmented pixels in each PVG column on the GPU using CuPy.
+
+    :param s: segmented area (T x pixels)
+    :type s: numpy.ndarray
+    :param bins: PVG column for each pixel (pixels or T x pixels)
+    :type bins: numpy.ndarray
+    :param steps: PVG resolution, defaults to 64
+    :type steps: int, optional
+    :return: PVG, time x 2*steps
+    :rtype: numpy.ndarray
+    """
+    import cupy as cp
+
+    n_bins = steps * 2 + 1
+    frame, pixel = cp.nonzero(cp.asarray(s))
+    bins = cp.asarray(bins)
+
+    if bins.ndim == 1:
+        column = bins[pixel]
+
+    else:
+        column = bins[frame, pixel]
+
+    # One histogram across all frames, each frame with its own set of columns
+    pvg = cp.bincount(frame * n_bins + column, minlength=s.shape[0] * n_bins)
+
+    return cp.asnumpy(pvg.reshape(s.shape[0], n_bins)[:, :steps * 2]).astype(np.float64)
+
+def compute_pvg(s, labels, steps=64, backend='cpu'):
     """Calculates Phonovibrogram based on labels.
 
     :param s: segmented area (TxYxX)
     :type s: numpy.ndarray
-    :param labels: labelled image
+    :param labels: labelled image for each frame (TxYxX) or for all frames (YxX)
     :type labels: numpy.ndarray
     :param steps: PVG resolution, defaults to 64
     :type steps: int, optional
+    :param backend: compute on 'cpu' or on 'gpu' (requires CuPy), defaults to 'cpu'
+    :type backend: str, optional
     :return: PVG, time x 2*steps
     :rtype: numpy.ndarray
     """
+    assert backend in ('cpu', 'gpu'), "selected backend ({}) not available!".format(backend)
+
+    s = np.ascontiguousarray(s.reshape(s.shape[0], -1), dtype=np.bool_)
+
+    # Static labels are mapped only once and reused for each frame
+    if labels.ndim == 2:
+        bins = _pvg_bins(labels, steps).ravel()
+
+    else:
+        bins = _pvg_bins(labels, steps).reshape(s.shape)
+
+    if backend == 'gpu':
+        return _pvg_histogram_gpu(s, bins, steps)
+
     pvg = np.zeros((s.shape[0], steps * 2))
-    l = np.zeros((steps*2, )+labels.shape[1:], dtype=np.bool_)
-    
-    all_steps = np.arange(1, steps*2+1)
-    all_steps[:steps] = all_steps[:steps][::-1]
-    all_steps[steps:] = -(all_steps[steps:] - steps)
+    bins = np.broadcast_to(bins, s.shape)
     
-    for frame in range(s.shape[0]):
-        f = s[frame]
-        
-        for i, j in enumerate(all_steps):
-            l[i] = labels[frame] == j
-        
-        for i in range(steps*2):
-            pvg[frame, i] = (f & l[i]).sum()
-
-    return pvg
\ No newline at end of file
+    # Pad pixels to full 64 bit words
+    if s.shape[1] % 8:
+        s = np.pad(s, ((0, 0), (0, 8 - s.shape[1] % 8)))
+
+    # Histogram of segmented pixels across PVG columns
+    _pvg_histogram(s, s.view(np.uint64), bins, pvg)
+
+    return pvg